@@ -1,36 +1,94 @@
+import argparse
+import datetime
 import os
+import statistics
 import sys
 import subprocess
+import tempfile
+import time
+import zipapp
 from pathlib import Path
-import PyInstaller.__main__
 import shutil
 import tarfile
+from typing import List
 
+# Number of status calls used to benchmark the startup time of a release.
+BENCHMARK_RUNS = 10
+# History of all benchmarks. Kept outside of release/, which is recreated on every build.
+BENCHMARK_HISTORY = 'startup_benchmark.txt'
 
-def build():
+
+def build(mode: str):
     """
-    Running PyInstaller
+    Running PyInstaller or packing a zipapp.
+    @param mode: 'onefile', 'onedir' or 'zipapp'
     """
+    if mode == 'zipapp':
+        build_zipapp()
+        return
+
+    import PyInstaller.__main__
+    pyinstaller_args = ['backup.py', '--onedir' if mode == 'onedir' else '--onefile', '-y']
+    # the OpenSSL libraries of miniconda are needed on windows for both, onefile and onedir.
     if os.name == 'nt':
         miniconda_path: os.PathLike = Path(sys.executable).parents[2]
         oppenssl_path = os.path.join(miniconda_path, 'pkgs/openssl-1.1.1l-h8ffe710_0/Library/bin')
         oppenssl_path = oppenssl_path.replace(os.sep, '/')
         print(f"OpenSSL path {oppenssl_path}.")
-        PyInstaller.__main__.run([
-            'backup.py',
-            '--onefile',
-            '-F',
-            '-y',
-            f'--paths',
-            '{oppenssl_path}'
-        ])
-    else:
-        PyInstaller.__main__.run([
-            'backup.py',
-            '--onefile',
-            '-F',
-            '-y',
-        ])
+        pyinstaller_args += ['--paths', oppenssl_path]
+    PyInstaller.__main__.run(pyinstaller_args)
+
+
+def build_zipapp():
+    """
+    Packs the sources to dist/backup.pyz. Needs a python interpreter on the target machine, but does not
+    unpack itself on every invocation like the onefile build.
+    """
+    if os.path.isdir('build'):
+        shutil.rmtree('build')
+    shutil.copytree('utils', 'build/utils', ignore=shutil.ignore_patterns('__pycache__'))
+    shutil.copytree('submodules', 'build/submodules', ignore=shutil.ignore_patterns('__pycache__', '.git'))
+    shutil.copy('backup.py', 'build')
+    os.makedirs('dist', exist_ok=True)
+    zipapp.create_archive('build', 'dist/backup.pyz', interpreter='/usr/bin/env python3', main='backup:main')
+
+
+def get_release_command(mode: str) -> List[str]:
+    """
+    @param mode: 'onefile', 'onedir' or 'zipapp'
+    @return: Command to start the released program.
+    """
+    executable = 'backup.exe' if os.name == 'nt' else 'backup'
+    if mode == 'zipapp':
+        return [sys.executable, 'release/backup/backup.pyz']
+    elif mode == 'onedir':
+        return [os.path.join('release/backup/backup', executable)]
+    return [os.path.join('release/backup', executable)]
+
+
+def benchmark_startup(mode: str):
+    """
+    Measures the startup time of the release by calling the lightweight status command. The result is
+    appended to BENCHMARK_HISTORY and written to the release folder, so it is packed with the release.
+    A release failing to start raises an exception.
+    @param mode: 'onefile', 'onedir' or 'zipapp'
+    """
+    cmd = get_release_command(mode)
+    timings: List[float] = []
+    with tempfile.TemporaryDirectory() as destination:
+        for _ in range(BENCHMARK_RUNS):
+            start = time.perf_counter()
+            subprocess.run([*cmd, 'status', '-d', destination], stdout=subprocess.DEVNULL, check=True)
+            timings.append(time.perf_counter() - start)
+
+    result = f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {mode}: startup of 'status' " \
+             f"median {statistics.median(timings) * 1000:.1f} ms, " \
+             f"min {min(timings) * 1000:.1f} ms over {BENCHMARK_RUNS} runs."
+    print(result)
+    with open(BENCHMARK_HISTORY, 'a') as benchmark_file:
+        benchmark_file.write(result + '\n')
+    with open('release/backup/startup_benchmark.txt', 'w') as benchmark_file:
+        benchmark_file.write(result + '\n')
 
 
 def cleanup():
@@ -57,16 +115,19 @@ def make_tarfile(source_dir, output_filename):
         tar.add(source_dir, arcname=os.path.basename(source_dir))
 
 
-def make_release():
+def make_release(mode: str):
     """
-    Make a directory for the release and pack it with all dependencies.
+    Make a directory for the release, benchmark it and pack it with all dependencies.
+    @param mode: 'onefile', 'onedir' or 'zipapp'
     """
     if os.path.isdir('release'):
         shutil.rmtree('release')
 
+    shutil.copytree('dist/', 'release/backup')
+    shutil.copy('README.md', 'release/backup')
+    benchmark_startup(mode)
+
     if os.name == 'nt':
-        shutil.copytree('dist/', 'release/backup')
-        shutil.copy('README.md', 'release/backup')
         out = subprocess.check_output(["C:/Program Files/7-Zip/7z.exe",
                                        'a', '-t7z', './release/backup.7z', 'release/backup'])
         print(out.decode("UTF-8"))
@@ -74,14 +135,18 @@ def make_release():
                                        'a', './release/backup.zip', 'release/backup'])
         print(out.decode("UTF-8"))
     else:
-        shutil.copytree('dist/', 'release/backup')
-        shutil.copy('README.md', 'release/backup')
         make_tarfile('release/backup', 'release/backup.tar.gz')
 
 
 def main():
-    build()
-    make_release()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--mode', choices=['onefile', 'onedir', 'zipapp'], default='onefile',
+                        help="onefile: single executable (slow startup, as it unpacks itself on every call), "
+                             "onedir: executable with its libraries in a folder, "
+                             "zipapp: python zip application, needs python3 on the target. Default: onefile")
+    args = parser.parse_args()
+    build(args.mode)
+    make_release(args.mode)
     cleanup()
 
 
@@ -0,0 +1,116 @@
+"""
+Read-only access to the backup series. This module is used by the status commands and therefore must only
+import lightweight modules - no logging, no rsync machinery.
+"""
+import configparser
+import os
+import socket
+from os import PathLike
+from pathlib import Path
+from typing import List, Optional
+from utils.datetimeutils import string_to_datetime, datetime_to_string
+
+
+def get_current_series_name():
+    """
+    Return name of current backup series
+    @return: name of current backup series
+    """
+    return "active_series"
+
+
+def get_path_to_backup_series(destination_path: PathLike) -> PathLike:
+    """
+    @param destination_path: Backup path
+    @return: Returns the backup-path with a simple addition to indicate where the current backup-series is being placed.
+    """
+    return Path(os.path.join(destination_path, Path(get_current_series_name())))
+
+
+def read_series_config(destination_path: PathLike) -> configparser.ConfigParser:
+    """
+    Reads the cfg.ini of the current backup series without modifying it.
+    @param destination_path: Backup path
+    @return: Config parser, empty if there is no current series.
+    """
+    config = configparser.ConfigParser()
+    config.read(os.path.join(get_path_to_backup_series(destination_path), 'cfg.ini'))
+    return config
+
+
+def get_active_status(destination_path: PathLike) -> Optional[configparser.SectionProxy]:
+    """
+    @param destination_path: Backup path
+    @return: The ACTIVE section of the current series or None if no backup is running or left over.
+             Note that a running backup is marked 'failed' until it completes, see is_backup_running.
+    """
+    config = read_series_config(destination_path)
+    if not config.has_section('ACTIVE'):
+        return None
+    return config['ACTIVE']
+
+
+def is_process_alive(pid: int) -> bool:
+    """
+    @param pid: Process id on this host.
+    @return: True if a process with this id exists.
+    """
+    if os.name == 'nt':
+        # os.kill would terminate the process on windows.
+        import ctypes
+        process_query_limited_information = 0x1000
+        still_active = 259
+        handle = ctypes.windll.kernel32.OpenProcess(process_query_limited_information, False, pid)
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == still_active
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def is_backup_running(active: configparser.SectionProxy) -> bool:
+    """
+    A running backup is marked 'failed' until it completes. It is told apart from a failed one by the
+    process id written to the ACTIVE section.
+    @param active: ACTIVE section of the current series.
+    @return: True if the process which wrote the ACTIVE section still runs on this host.
+    """
+    if active.get('status') != 'failed' or active.get('host') != socket.gethostname():
+        return False
+    try:
+        return is_process_alive(int(active.get('pid', '')))
+    except ValueError:
+        return False
+
+
+def get_last_successful_timestamp(destination_path: PathLike) -> str:
+    """
+    Searches the current series for the most recent completed backup. If the current series has none,
+    e.g. as a new full backup just started, the previous series named by their last timestamp are used.
+    @param destination_path: Backup path
+    @return: timestamp of the last successful backup, empty if there is none.
+    """
+    timestamps: List[str] = [sec for sec in read_series_config(destination_path).sections() if sec != 'ACTIVE']
+    if not timestamps and os.path.isdir(destination_path):
+        timestamps = [entry.name for entry in os.scandir(destination_path) if entry.is_dir()]
+
+    sec_times = []
+    for timestamp in timestamps:
+        try:
+            sec_times.append(string_to_datetime(timestamp))
+        except ValueError:
+            continue
+
+    if not sec_times:
+        return ""
+    return datetime_to_string(max(sec_times))
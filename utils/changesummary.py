@@ -1,22 +1,33 @@
+from utils.deletionguard import DELETION_PATTERN
+
+
 class ChangeSummary:
     """
     Change summary of the last backup run.
     """
 
-    def __init__(self, rsync_summary_string: str):
+    def __init__(self, rsync_summary_string: str, num_deletions: int = 0):
         """
         @param rsync_summary_string: Result string from rsync command.
+        @param num_deletions: Number of deletions as counted by the deletion guard.
         """
         self.__num_changes_tot = 0
         self.__num_changes_directories = 0
         self.__num_changes_files = 0
+        self.__num_deletions = num_deletions
 
         if not rsync_summary_string:
             return
         if not rsync_summary_string.find("sending incremental file list") < 0 and rsync_summary_string.find(
                 "(DRY RUN)") < 0:
-            self.__num_changes_tot = rsync_summary_string.count('\n') - 4
-            self.__num_changes_directories = rsync_summary_string.count('/\n')
+            # the file list ends with the first empty line, what follows are the statistics.
+            file_list = rsync_summary_string.split("sending incremental file list\n", 1)[1].split("\n\n", 1)[0]
+            for line in file_list.splitlines():
+                if not line or DELETION_PATTERN.match(line):
+                    continue
+                self.__num_changes_tot += 1
+                if line.endswith('/'):
+                    self.__num_changes_directories += 1
             self.__num_changes_files = self.__num_changes_tot - self.__num_changes_directories
 
     @property
@@ -25,4 +36,5 @@ class ChangeSummary:
         @return: A summary string of the changes performed.
         """
         return f"Counted {self.__num_changes_tot} changes to last backup with {self.__num_changes_directories} " \
-               f"directories and {self.__num_changes_files} files involved. "
+               f"directories and {self.__num_changes_files} files involved. " \
+               f"{self.__num_deletions} files or directories were deleted. "
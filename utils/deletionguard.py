@@ -0,0 +1,113 @@
+import re
+from typing import List, Optional
+
+# rsync prints deletions as 'deleting <path>', with --itemize-changes or %i in --out-format as '*deleting <path>'.
+DELETION_PATTERN = re.compile(r"^\*?deleting\s+")
+
+
+class MassDeletionError(Exception):
+    """
+    Raised when rsync is about to remove more files than the deletion guard allows.
+    """
+    pass
+
+
+class DeletionGuard:
+    """
+    Watches the rsync output while it is streamed and trips as soon as the number of deletions exceeds
+    the configured limits. Deletions are recognized by rsync's 'deleting ' lines, see rsync_parameters.
+    It also picks up the number of files from rsync's --stats output, which is stored with the backup
+    as base for the percentage limit of the next run.
+    """
+
+    __NUM_FILES_PATTERN = re.compile(r"^Number of files: (\S+)")
+    # plain number with thousands separators. Human readable numbers like 12.35K are not accepted.
+    __PLAIN_NUMBER_PATTERN = re.compile(r"^\d[\d,.']*$")
+
+    def __init__(self, max_deletions: Optional[int], max_deletion_percent: Optional[float]):
+        """
+        Constructor may raise an exception when encountering invalid limits.
+        @param max_deletions: Absolute number of deletions allowed, None for no limit.
+        @param max_deletion_percent: Deletions allowed in percent of the previous snapshot's file count,
+                                     None for no limit.
+        """
+        if max_deletions is not None and max_deletions < 0:
+            raise Exception("Maximum number of deletions must not be negative.")
+        if max_deletion_percent is not None and not 0 <= max_deletion_percent <= 100:
+            raise Exception("Maximum percentage of deletions must be between 0 and 100.")
+        self.__max_deletions: Optional[int] = max_deletions
+        self.__max_deletion_percent: Optional[float] = max_deletion_percent
+        self.__num_files_previous: Optional[int] = None
+        self.__num_deletions: int = 0
+        self.__num_files: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        """
+        @return: True if any limit is configured.
+        """
+        return self.__max_deletions is not None or self.__max_deletion_percent is not None
+
+    @property
+    def needs_file_count(self) -> bool:
+        """
+        @return: True if the file count of the previous snapshot is needed to evaluate the limits.
+        """
+        return self.__max_deletion_percent is not None
+
+    @property
+    def rsync_parameters(self) -> List[str]:
+        """
+        @return: Parameters rsync needs for the guard to work: --info=del prints the deletions even if rsync is
+                 not verbose, --stats prints the number of files and --no-human-readable makes it an exact
+                 number, also if -h was given before. Empty if the guard is disabled.
+        """
+        if not self.enabled:
+            return []
+        return ["--info=del", "--stats", "--no-human-readable"]
+
+    @property
+    def num_deletions(self) -> int:
+        return self.__num_deletions
+
+    @property
+    def num_files(self) -> Optional[int]:
+        """
+        @return: Number of files and directories reported by rsync --stats, None if rsync did not report it
+                 as exact number.
+        """
+        return self.__num_files
+
+    def set_previous_file_count(self, num_files: Optional[int]):
+        """
+        @param num_files: Number of files and directories of the previous snapshot as base for the percentage
+                          limit, None if unknown. Then only the absolute limit applies.
+        """
+        self.__num_files_previous = num_files
+
+    def register(self, rsync_line: str):
+        """
+        Feed one line of rsync output to the guard.
+        @param rsync_line: Line as printed by rsync.
+        @raise MassDeletionError: If the line pushes the deletions over one of the limits.
+        """
+        num_files_match = self.__NUM_FILES_PATTERN.match(rsync_line)
+        if num_files_match:
+            number = num_files_match.group(1)
+            if self.__PLAIN_NUMBER_PATTERN.match(number):
+                self.__num_files = int(re.sub(r"[,.']", "", number))
+            return
+        if not DELETION_PATTERN.match(rsync_line):
+            return
+        self.__num_deletions += 1
+
+        if self.__max_deletions is not None and self.__num_deletions > self.__max_deletions:
+            raise MassDeletionError(f"rsync deleted more than {self.__max_deletions} files. Stopped rsync in order "
+                                    f"to protect the backup.")
+
+        if self.__max_deletion_percent is not None and self.__num_files_previous:
+            percent = 100.0 * self.__num_deletions / self.__num_files_previous
+            if percent > self.__max_deletion_percent:
+                raise MassDeletionError(f"rsync deleted {self.__num_deletions} of {self.__num_files_previous} files "
+                                        f"which is more than {self.__max_deletion_percent}%. Stopped rsync in order "
+                                        f"to protect the backup.")
@@ -0,0 +1,72 @@
+import os
+from typing import List
+
+
+class ObjectStore:
+    """
+    Minimal object store interface used by the snapshot export. Implement put/get/list for other
+    storages (e.g. an S3 bucket) - objects are written once and never modified.
+    """
+
+    def put(self, name: str, data: bytes):
+        """
+        @param name: Object name, may contain '/' as separator.
+        @param data: Content of the object.
+        """
+        raise NotImplementedError
+
+    def get(self, name: str) -> bytes:
+        """
+        @param name: Object name
+        @return: Content of the object.
+        """
+        raise NotImplementedError
+
+    def list(self, prefix: str = "") -> List[str]:
+        """
+        @param prefix: Only return objects starting with this prefix.
+        @return: Sorted object names.
+        """
+        raise NotImplementedError
+
+
+class DirectoryStore(ObjectStore):
+    """
+    Object store writing each object to a file within a local directory.
+    """
+
+    def __init__(self, path: str):
+        """
+        @param path: Root directory of the store. Created if it does not exist.
+        """
+        self.__path: str = path
+        os.makedirs(path, exist_ok=True)
+
+    def __object_path(self, name: str) -> str:
+        parts = name.split('/')
+        if any(part in ('', '.', '..') for part in parts):
+            raise Exception(f"Invalid object name '{name}'.")
+        return os.path.join(self.__path, *parts)
+
+    def put(self, name: str, data: bytes):
+        path = self.__object_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so that an interrupted export never leaves a truncated object behind.
+        with open(path + '.part', 'wb') as object_file:
+            object_file.write(data)
+        os.replace(path + '.part', path)
+
+    def get(self, name: str) -> bytes:
+        with open(self.__object_path(name), 'rb') as object_file:
+            return object_file.read()
+
+    def list(self, prefix: str = "") -> List[str]:
+        names: List[str] = []
+        for root, _, files in os.walk(self.__path):
+            for file in files:
+                if file.endswith('.part'):
+                    continue
+                name = os.path.relpath(os.path.join(root, file), self.__path).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
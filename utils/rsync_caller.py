@@ -1,19 +1,24 @@
 from submodules.python_core_libs.logging.project_logger import Log
+from utils.deletionguard import DeletionGuard
 from utils.rsyncpolicy import RsyncPolicy
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import subprocess
+import threading
 import os
 from utils.changesummary import ChangeSummary
 
 
 class RsyncCaller:
     @staticmethod
-    def sync_data(sources: List[str], active_backup_path: str, rsync_policy: RsyncPolicy) -> Tuple[ChangeSummary, str]:
+    def sync_data(sources: List[str], active_backup_path: str, rsync_policy: RsyncPolicy,
+                  deletion_guard: Optional[DeletionGuard] = None) -> Tuple[ChangeSummary, str]:
         """
         Making the actual rsync call.
         @param sources: List of source paths
         @param active_backup_path: backup path for the current timestamp.
         @param rsync_policy: Policy in which the parameters of the rsync call are assembled.
+        @param deletion_guard: Optional guard watching the deletions while rsync runs. Raises a
+                               MassDeletionError after stopping rsync if a limit is exceeded.
         @return: 1) Change summary of rsync. Can be used to see if a really large amount of files was removed.
                  2) Used rsync cmd
         """
@@ -31,15 +36,9 @@ class RsyncCaller:
 
             rsync_cmd = rsync_cmd + " " + active_backup_path
             logger.info(f"rsync command reads: {rsync_cmd}")
-            out = ""
-            with subprocess.Popen(['rsync', *rsync_policy.parameters, *sources, active_backup_path],
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1,
-                                  universal_newlines=True) as p:
-                for line in p.stdout:
-                    out += line
-                    logger.info(line.strip('\n'))  # process line here
-
-            summary: ChangeSummary = ChangeSummary(out)
+            out = RsyncCaller.run_rsync(['rsync', *rsync_policy.parameters, *sources, active_backup_path],
+                                        deletion_guard)
+            summary: ChangeSummary = ChangeSummary(out, deletion_guard.num_deletions if deletion_guard else 0)
             return summary, rsync_cmd
 
         else:
@@ -69,17 +68,47 @@ class RsyncCaller:
 
             rsync_cmd = rsync_cmd + " " + backup_wsl_path
             logger.info(f"rsync command reads: {rsync_cmd}")
-            out = ""
-            with subprocess.Popen(['wsl', 'rsync', *rsync_policy.parameters, *wsl_sources, backup_wsl_path],
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE, bufsize=1, universal_newlines=True) as p:
-                for line in p.stdout:
-                    out += line
-                    logger.info(line.strip('\n'))  # process line here
-
-            summary: ChangeSummary = ChangeSummary(out)
+            out = RsyncCaller.run_rsync(['wsl', 'rsync', *rsync_policy.parameters, *wsl_sources, backup_wsl_path],
+                                        deletion_guard)
+            summary: ChangeSummary = ChangeSummary(out, deletion_guard.num_deletions if deletion_guard else 0)
             return summary, rsync_cmd
 
+    @staticmethod
+    def run_rsync(cmd: List[str], deletion_guard: Optional[DeletionGuard]) -> str:
+        """
+        Runs rsync and streams its output to the log and the deletion guard. Raises an exception if rsync
+        fails, except for vanished source files (exit code 24), which are only logged.
+        @param cmd: rsync command as argument list.
+        @param deletion_guard: Optional guard, may be None.
+        @return: Complete output of rsync.
+        """
+        logger = Log.instance().logger
+        out = ""
+        errors: List[str] = []
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1,
+                              universal_newlines=True) as p:
+            # stderr is read in parallel, a full stderr pipe would block rsync.
+            stderr_reader = threading.Thread(target=lambda: errors.extend(p.stderr), daemon=True)
+            stderr_reader.start()
+            for line in p.stdout:
+                out += line
+                logger.info(line.strip('\n'))  # process line here
+                if deletion_guard is not None:
+                    try:
+                        deletion_guard.register(line)
+                    except Exception:
+                        p.terminate()
+                        raise
+            stderr_reader.join()
+
+        for error in errors:
+            logger.error(f"rsync: {error.strip()}")
+        if p.returncode == 24:
+            logger.warning("rsync reported vanished source files.")
+        elif p.returncode != 0:
+            raise Exception(f"rsync failed with exit code {p.returncode}: {''.join(errors).strip()}")
+        return out
+
     @staticmethod
     def check_if_sources_are_empty(sources: List[str]):
         """
@@ -0,0 +1,411 @@
+"""
+Export of snapshots to chunked, compressed and encrypted archives in an object store and the matching import.
+
+The snapshot is streamed as tar into fixed size chunks. Chunks are compressed and encrypted by a thread pool
+(zlib and AES release the GIL, so this uses multiple cores) and written to the store in order. The chunks in
+flight are limited to buffer_size bytes of plain data, which bounds the memory used independent of the
+snapshot size and the number of cpus. With their compressed copies this takes up to about 2 * buffer_size.
+The manifest is written last, so an archive without manifest is incomplete. It lists the chunks with their
+hashes and is authenticated by an HMAC, so chunks can neither be altered, reordered nor dropped.
+
+Encryption uses AES-256-GCM from the 'cryptography' package, which is only needed for export and import.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import io
+import json
+import os
+import secrets
+import shutil
+import tarfile
+import zlib
+from typing import Callable, Deque, Iterator, List, Optional, Tuple
+from utils.objectstore import ObjectStore
+
+ARCHIVE_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+# tar member holding the paths removed since the base snapshot of a delta export.
+DELETED_MEMBER = '.backup-export-deleted.json'
+NONCE_SIZE = 12
+DEFAULT_CHUNK_SIZE = 64 * 2 ** 20
+DEFAULT_BUFFER_SIZE = 512 * 2 ** 20
+SCRYPT_N = 2 ** 15
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def _aesgcm(key: bytes):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise Exception("Export and import need the 'cryptography' package. Install it with "
+                        "'pip install cryptography'.")
+    return AESGCM(key)
+
+
+def derive_keys(passphrase: bytes, salt: bytes, n: int = SCRYPT_N, r: int = SCRYPT_R,
+                p: int = SCRYPT_P) -> Tuple[bytes, bytes]:
+    """
+    @param passphrase: Passphrase as read from the key file.
+    @param salt: Random salt stored in the manifest.
+    @param n: scrypt cost parameter
+    @param r: scrypt block size
+    @param p: scrypt parallelization
+    @return: 1) 256 bit key for the chunk encryption
+             2) 256 bit key for the manifest HMAC
+    """
+    keys = hashlib.scrypt(passphrase, salt=salt, n=n, r=r, p=p, maxmem=2 ** 26, dklen=64)
+    return keys[:32], keys[32:]
+
+
+def manifest_hmac(manifest: dict, mac_key: bytes) -> str:
+    """
+    @param manifest: Manifest, an existing 'hmac' entry is ignored.
+    @param mac_key: Key for the HMAC as returned by derive_keys.
+    @return: HMAC-SHA256 over the canonical json of the manifest as hex string.
+    """
+    content = {key: value for key, value in manifest.items() if key != 'hmac'}
+    data = json.dumps(content, sort_keys=True, separators=(',', ':')).encode()
+    return hmac.new(mac_key, data, hashlib.sha256).hexdigest()
+
+
+def check_pipeline_parameters(workers: int, buffer_size: int, chunk_size: int = 1, compresslevel: int = 6):
+    """
+    Raises an exception if one of the parameters is out of range.
+    @param workers: Number of threads, 0 for one per cpu.
+    @param buffer_size: Maximum size of the uncompressed chunks in flight in bytes.
+    @param chunk_size: Size of the uncompressed chunks in bytes.
+    @param compresslevel: zlib compression level.
+    """
+    if workers < 0:
+        raise Exception("Number of workers must not be negative.")
+    if buffer_size <= 0:
+        raise Exception("Buffer size must be positive.")
+    if chunk_size <= 0:
+        raise Exception("Chunk size must be positive.")
+    if not -1 <= compresslevel <= 9:
+        raise Exception("Compression level must be between -1 and 9.")
+
+
+def max_chunks_in_flight(buffer_size: int, chunk_size: int) -> int:
+    """
+    @param buffer_size: Maximum size of the uncompressed chunks in flight in bytes.
+    @param chunk_size: Size of the uncompressed chunks in bytes.
+    @return: Number of chunks which may be in flight, at least one.
+    """
+    return max(1, buffer_size // chunk_size)
+
+
+def read_passphrase(key_file: str) -> bytes:
+    """
+    @param key_file: Path to file containing the passphrase.
+    @return: Passphrase without trailing line break.
+    """
+    with open(key_file, 'rb') as kf:
+        passphrase = kf.read().rstrip(b'\r\n')
+    if not passphrase:
+        raise Exception(f"Key file {key_file} is empty.")
+    return passphrase
+
+
+class _ChunkWriter(io.RawIOBase):
+    """
+    Write end of the export pipeline. Cuts the tar stream into chunks and hands them to a callback.
+    """
+
+    def __init__(self, chunk_size: int, emit: Callable[[bytes], None]):
+        super().__init__()
+        self.__chunk_size: int = chunk_size
+        self.__emit: Callable[[bytes], None] = emit
+        self.__buffer: bytearray = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.__buffer += data
+        while len(self.__buffer) >= self.__chunk_size:
+            self.__emit(bytes(self.__buffer[:self.__chunk_size]))
+            del self.__buffer[:self.__chunk_size]
+        return len(data)
+
+    def finish(self):
+        """
+        Hands the last, possibly smaller chunk to the callback.
+        """
+        if self.__buffer:
+            self.__emit(bytes(self.__buffer))
+            self.__buffer = bytearray()
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    Read end of the import pipeline. Concatenates the decrypted chunks to the tar stream.
+    """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        super().__init__()
+        self.__chunks: Iterator[bytes] = chunks
+        self.__buffer: memoryview = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while not self.__buffer:
+            chunk = next(self.__chunks, None)
+            if chunk is None:
+                return 0
+            self.__buffer = memoryview(chunk)
+        size = min(len(target), len(self.__buffer))
+        target[:size] = self.__buffer[:size]
+        self.__buffer = self.__buffer[size:]
+        return size
+
+
+class SnapshotArchive:
+    @staticmethod
+    def export(snapshot_path: str, store: ObjectStore, name: str, passphrase: bytes,
+               base_path: Optional[str] = None, chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = 0,
+               compresslevel: int = 6, buffer_size: int = DEFAULT_BUFFER_SIZE) -> dict:
+        """
+        Streams a snapshot to an archive in the store.
+        @param snapshot_path: Path to the snapshot, e.g. <destination>/active_series/<timestamp>
+        @param store: Object store the archive is written to.
+        @param name: Name of the archive, used as prefix of all its objects.
+        @param passphrase: Passphrase the encryption key is derived from.
+        @param base_path: If given, only files which are not hard links to the same file in this snapshot
+                          are exported, together with the paths removed since then (delta export).
+        @param chunk_size: Size of the uncompressed chunks in bytes.
+        @param workers: Number of compression threads, 0 for one per cpu.
+        @param compresslevel: zlib compression level.
+        @param buffer_size: Maximum size of the uncompressed chunks in flight in bytes.
+        @return: The manifest written.
+        """
+        if not os.path.isdir(snapshot_path):
+            raise Exception(f"Snapshot {snapshot_path} does not exist.")
+        if base_path is not None and not os.path.isdir(base_path):
+            raise Exception(f"Base snapshot {base_path} does not exist.")
+        check_pipeline_parameters(workers, buffer_size, chunk_size, compresslevel)
+        # chunks of an archive without manifest are left overs of a failed export and are overwritten.
+        if f"{name}/{MANIFEST_NAME}" in store.list(f"{name}/"):
+            raise Exception(f"Archive {name} already exists in the store.")
+
+        max_in_flight = max_chunks_in_flight(buffer_size, chunk_size)
+        workers = min(workers or os.cpu_count() or 1, max_in_flight)
+        salt = secrets.token_bytes(16)
+        key, mac_key = derive_keys(passphrase, salt)
+        cipher = _aesgcm(key)
+        chunks: List[dict] = []
+        in_flight: Deque[concurrent.futures.Future] = collections.deque()
+
+        def pack(index: int, data: bytes) -> bytes:
+            nonce = secrets.token_bytes(NONCE_SIZE)
+            return nonce + cipher.encrypt(nonce, zlib.compress(data, compresslevel), f"{name}/{index}".encode())
+
+        def store_oldest():
+            index = len(chunks)
+            data = in_flight.popleft().result()
+            chunk_name = f"chunk-{index:08d}"
+            store.put(f"{name}/{chunk_name}", data)
+            chunks.append({'name': chunk_name, 'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()})
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            def emit(data: bytes):
+                # blocks the producer until the oldest chunk is stored, if too many chunks are pending.
+                if len(in_flight) >= max_in_flight:
+                    store_oldest()
+                in_flight.append(pool.submit(pack, len(chunks) + len(in_flight), data))
+
+            writer = _ChunkWriter(chunk_size, emit)
+            with tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                SnapshotArchive.__add_snapshot(tar, snapshot_path, base_path)
+            writer.finish()
+            while in_flight:
+                store_oldest()
+
+        manifest = {
+            'version': ARCHIVE_VERSION,
+            'snapshot': os.path.basename(os.path.normpath(snapshot_path)),
+            'base': os.path.basename(os.path.normpath(base_path)) if base_path is not None else None,
+            'chunk_size': chunk_size,
+            'compression': 'zlib',
+            'cipher': 'AES-256-GCM',
+            'kdf': {'name': 'scrypt', 'salt': salt.hex(), 'n': SCRYPT_N, 'r': SCRYPT_R, 'p': SCRYPT_P},
+            'chunks': chunks,
+        }
+        manifest['hmac'] = manifest_hmac(manifest, mac_key)
+        store.put(f"{name}/{MANIFEST_NAME}", json.dumps(manifest, indent=1).encode())
+        return manifest
+
+    @staticmethod
+    def __add_snapshot(tar: tarfile.TarFile, snapshot_path: str, base_path: Optional[str]):
+        """
+        Adds all entries of the snapshot, in case of a delta only the changed ones, to the tar stream.
+        """
+        for root, dirs, files in os.walk(snapshot_path):
+            dirs.sort()
+            rel_root = os.path.relpath(root, snapshot_path)
+            if rel_root != '.':
+                tar.add(root, arcname=rel_root, recursive=False)
+            for entry in sorted(files) + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+                path = os.path.join(root, entry)
+                rel_path = os.path.normpath(os.path.join(rel_root, entry))
+                if base_path is not None and SnapshotArchive.__is_unchanged(path, os.path.join(base_path, rel_path)):
+                    continue
+                tar.add(path, arcname=rel_path, recursive=False)
+
+        if base_path is None:
+            return
+        deleted: List[str] = []
+        for root, dirs, files in os.walk(base_path):
+            rel_root = os.path.relpath(root, base_path)
+            for entry in dirs + files:
+                rel_path = os.path.normpath(os.path.join(rel_root, entry))
+                if not os.path.lexists(os.path.join(snapshot_path, rel_path)):
+                    deleted.append(rel_path.replace(os.sep, '/'))
+            # no need to descend into removed directories, their removal covers the content.
+            dirs[:] = [d for d in dirs if os.path.lexists(os.path.join(snapshot_path, rel_root, d))]
+        data = json.dumps(sorted(deleted)).encode()
+        info = tarfile.TarInfo(DELETED_MEMBER)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    @staticmethod
+    def __is_unchanged(path: str, base_path: str) -> bool:
+        """
+        Incremental backups hard link unchanged files to the previous snapshot, so same inode means unchanged.
+        """
+        try:
+            stat, base_stat = os.lstat(path), os.lstat(base_path)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return stat.st_ino == base_stat.st_ino and stat.st_dev == base_stat.st_dev
+
+    @staticmethod
+    def restore(store: ObjectStore, name: str, passphrase: bytes, target_path: str, workers: int = 0,
+                buffer_size: int = DEFAULT_BUFFER_SIZE) -> dict:
+        """
+        Imports an archive to a directory. A delta archive has to be imported on top of its restored base.
+        @param store: Object store the archive is read from.
+        @param name: Name of the archive.
+        @param passphrase: Passphrase used for the export.
+        @param target_path: Directory to restore to.
+        @param workers: Number of decompression threads, 0 for one per cpu.
+        @param buffer_size: Maximum size of the uncompressed chunks in flight in bytes.
+        @return: The manifest of the archive.
+        """
+        try:
+            manifest = json.loads(store.get(f"{name}/{MANIFEST_NAME}"))
+        except FileNotFoundError:
+            raise Exception(f"Archive {name} has no manifest. It does not exist or its export did not complete.")
+        if manifest['version'] != ARCHIVE_VERSION:
+            raise Exception(f"Archive version {manifest['version']} is not supported.")
+        check_pipeline_parameters(workers, buffer_size)
+
+        kdf = manifest['kdf']
+        key, mac_key = derive_keys(passphrase, bytes.fromhex(kdf['salt']), kdf['n'], kdf['r'], kdf['p'])
+        if not hmac.compare_digest(manifest.get('hmac', ''), manifest_hmac(manifest, mac_key)):
+            raise Exception(f"Manifest of archive {name} is not authentic. Wrong key file or tampered archive?")
+        if manifest['base'] is not None and not os.path.isdir(target_path):
+            raise Exception(f"Archive {name} is a delta to {manifest['base']}. Restore that to {target_path} first.")
+        # fail before the target is touched, a half applied delta would corrupt the restored base.
+        stored = set(store.list(f"{name}/"))
+        missing = [chunk['name'] for chunk in manifest['chunks'] if f"{name}/{chunk['name']}" not in stored]
+        if missing:
+            raise Exception(f"Archive {name} is incomplete, missing chunks: {', '.join(missing)}.")
+
+        max_in_flight = max_chunks_in_flight(buffer_size, manifest['chunk_size'])
+        workers = min(workers or os.cpu_count() or 1, max_in_flight)
+        cipher = _aesgcm(key)
+
+        def unpack(index: int, chunk: dict) -> bytes:
+            data = store.get(f"{name}/{chunk['name']}")
+            if hashlib.sha256(data).hexdigest() != chunk['sha256']:
+                raise Exception(f"Chunk {chunk['name']} of archive {name} is corrupt.")
+            nonce, ciphertext = data[:NONCE_SIZE], data[NONCE_SIZE:]
+            try:
+                compressed = cipher.decrypt(nonce, ciphertext, f"{name}/{index}".encode())
+            except Exception:
+                raise Exception(f"Cannot decrypt chunk {chunk['name']} of archive {name}. Wrong key file?")
+            return zlib.decompress(compressed)
+
+        os.makedirs(target_path, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            def decrypted_chunks() -> Iterator[bytes]:
+                in_flight: Deque[concurrent.futures.Future] = collections.deque()
+                for index, chunk in enumerate(manifest['chunks']):
+                    if len(in_flight) >= max_in_flight:
+                        yield in_flight.popleft().result()
+                    in_flight.append(pool.submit(unpack, index, chunk))
+                while in_flight:
+                    yield in_flight.popleft().result()
+
+            # members are filtered before anything at their path is touched.
+            use_filter = hasattr(tarfile, 'tar_filter')
+            extract_args = {'filter': 'fully_trusted'} if use_filter else {}
+            deleted: Optional[List[str]] = None
+            directories: List[tarfile.TarInfo] = []
+            with tarfile.open(fileobj=_ChunkReader(decrypted_chunks()), mode='r|') as tar:
+                for member in tar:
+                    if member.name == DELETED_MEMBER:
+                        deleted = json.loads(tar.extractfile(member).read())
+                        continue
+                    if use_filter:
+                        member = tarfile.tar_filter(member, target_path)
+                    path = os.path.join(target_path, member.name)
+                    # a delta replaces entries of its restored base, which may be read-only or of another type.
+                    if os.path.lexists(path) and not (member.isdir() and SnapshotArchive.__is_directory(path)):
+                        SnapshotArchive.__remove(path)
+                    if member.isdir():
+                        # like extractall, set the attributes of directories after their content is written.
+                        tar.extract(member, target_path, set_attrs=False, **extract_args)
+                        os.chmod(path, 0o700)
+                        directories.append(member)
+                    else:
+                        tar.extract(member, target_path, **extract_args)
+                # deletions are applied while the directories are still writable.
+                if manifest['base'] is not None:
+                    if deleted is None:
+                        raise Exception(f"Delta archive {name} is incomplete, the list of deleted paths is missing.")
+                    SnapshotArchive.__remove_deleted(target_path, deleted)
+                for member in reversed(directories):
+                    directory = os.path.join(target_path, member.name)
+                    tar.chown(member, directory, False)
+                    tar.utime(member, directory)
+                    tar.chmod(member, directory)
+
+        return manifest
+
+    @staticmethod
+    def __is_directory(path: str) -> bool:
+        return os.path.isdir(path) and not os.path.islink(path)
+
+    @staticmethod
+    def __remove(path: str):
+        """
+        Removes a file, link or directory tree, also if it is read-only.
+        """
+        if not SnapshotArchive.__is_directory(path):
+            os.remove(path)
+            return
+        for root, _, _ in os.walk(path):
+            os.chmod(root, 0o700)
+        shutil.rmtree(path)
+
+    @staticmethod
+    def __remove_deleted(target_path: str, deleted: List[str]):
+        """
+        Removes the paths deleted since the base snapshot from the restored directory.
+        """
+        root = os.path.realpath(target_path)
+        for rel_path in deleted:
+            # only resolve the parent, a deleted symlink itself must be removed and not its target.
+            path = os.path.join(root, *rel_path.split('/'))
+            path = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+            if os.path.commonpath([root, path]) != root or path == root:
+                raise Exception(f"Refusing to delete {rel_path} outside of {target_path}.")
+            if os.path.lexists(path):
+                SnapshotArchive.__remove(path)